@@ -1,6 +1,12 @@
-import json
+import asyncio
+import logging
 import os
+import socket
 import aiohttp
+import orjson
+import yarl
+from typing import Optional
+from orjson import dumps as _dumps
 
 from dotenv import load_dotenv
 from starlette.applications import Starlette
@@ -9,9 +15,12 @@ from starlette.templating import Jinja2Templates
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.websockets import WebSocket, WebSocketDisconnect
+from websockets.exceptions import ConnectionClosed
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 templates = Jinja2Templates("templates")
 
 BOT_NAME = os.environ.get("BOT_NAME", "신한투자증권 프로봇")
@@ -19,6 +28,11 @@ BOT_API_URL = os.environ.get(
     "BOT_API_URL",
     "https://bm0l8cj2xl.execute-api.ap-northeast-2.amazonaws.com/default/llm-lamda",
 )
+# 호출마다 BOT_API_URL을 다시 파싱하지 않도록 미리 yarl.URL로 만들어 둔다.
+_BOT_API_BASE_URL = yarl.URL(BOT_API_URL)
+
+# 앱 수명 동안 하나의 세션(커넥션 풀)을 재사용한다. (_startup/_shutdown 참고)
+SESSION: Optional[aiohttp.ClientSession] = None
 
 origins = [
     "http://localhost",
@@ -35,25 +49,100 @@ middleware = [
 ]
 
 
+# 봇 응답이 이 시간(초)보다 늦어질 때만 typing 프레임을 보낸다.
+_TYPING_DELAY = 0.3
+
+# 연결당 송신 큐에 쌓아 둘 수 있는 최대 프레임 수
+_OUT_QUEUE_SIZE = 64
+
+# 서버 오류로 연결을 정리할 때 남은 프레임을 보내며 기다릴 최대 시간(초)
+_FLUSH_TIMEOUT = 1.0
+
+# 수신 메시지 최대 크기(UTF-8 바이트). Procfile의 --ws-max-size(65536)보다 작게 잡아서
+# 그 사이 크기의 메시지는 연결을 끊지 않고 "너무 깁니다" 에러 프레임으로 돌려보낸다.
+_MAX_MESSAGE_BYTES = 16384
+
+# 매번 같은 프레임은 모듈 로드 시 한 번만 직렬화해 둔다.
+_GREETING_BYTES = _dumps(
+    {
+        "type": "greeting",
+        "role": "assistant",
+        "message": (
+            "안녕하세요 😊\n"
+            "신한투자증권 프로봇입니다.\n\n"
+            "클라우드, 개발, 기술 관련 질문이 있다면\n"
+            "편하게 물어보세요!"
+        ),
+    }
+)
+_TYPING_BYTES = _dumps(
+    {
+        "type": "typing",
+        "role": "system",
+        "message": f"{BOT_NAME}이(가) 입력 중입니다…",
+    }
+)
+_EMPTY_ERR_BYTES = _dumps(
+    {
+        "type": "error",
+        "role": "system",
+        "message": "빈 메시지는 처리할 수 없습니다.",
+    }
+)
+_TOO_LONG_ERR_BYTES = _dumps(
+    {
+        "type": "error",
+        "role": "system",
+        "message": "메시지가 너무 깁니다.",
+    }
+)
+
+_MESSAGE_PREFIX = b'{"type":"message","role":"assistant","message":'
+_MESSAGE_SUFFIX = b"}"
+
+# {"type":"error","role":"system","message":"<접두어><예외 메시지>"} 의 앞/뒤 조각
+_ERR_ENVELOPE_PREFIX = b'{"type":"error","role":"system","message":'
+_BOT_ERR_PREFIX = _ERR_ENVELOPE_PREFIX + _dumps("봇 호출 실패: ")[:-1]
+_SERVER_ERR_PREFIX = _ERR_ENVELOPE_PREFIX + _dumps("서버 오류: ")[:-1]
+_ERR_SUFFIX = b'"}'
+
+_FALLBACK_KEYS = ("text", "m", "userMessage")
+
+
 async def homepage(request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+def _too_long(raw: str) -> bool:
+    # UTF-8은 글자당 1~4바이트라 글자 수만으로 결론이 나면 인코딩(복사)을 건너뛴다.
+    n = len(raw)
+    if n > _MAX_MESSAGE_BYTES:
+        return True
+    if n * 4 <= _MAX_MESSAGE_BYTES:
+        return False
+    return len(raw.encode("utf-8")) > _MAX_MESSAGE_BYTES
+
+
 def _extract_user_message(payload: dict) -> str:
+    # 클라이언트 프로토콜은 {"message": "..."} 이므로 이 경우를 먼저 처리한다.
     v = payload.get("message")
-    if isinstance(v, str) and v.strip():
-        return v.strip()
+    if type(v) is str:
+        v = v.strip()
+        if v:
+            return v
     # 혹시라도 다른 키로 보내면 흡수
-    for k in ("text", "m", "userMessage"):
+    for k in _FALLBACK_KEYS:
         vv = payload.get(k)
-        if isinstance(vv, str) and vv.strip():
-            return vv.strip()
+        if type(vv) is str:
+            vv = vv.strip()
+            if vv:
+                return vv
     return ""
 
 
-async def call_bot_api_raw(user_text: str) -> str:
+async def call_bot_api_raw(user_text: str) -> bytes:
     """
-    봇 API(Lambda/API Gateway) 응답을 '원문 그대로' 문자열로 반환한다.
+    봇 API(Lambda/API Gateway) 응답을 '원문 그대로' 바이트로 반환한다.
     예:
     {
       "statusCode": 200,
@@ -62,118 +151,190 @@ async def call_bot_api_raw(user_text: str) -> str:
     }
     이런 텍스트를 그대로 반환.
     """
-    params = {"m": user_text}
-    timeout = aiohttp.ClientTimeout(total=45)
+    if SESSION is None:
+        # lifespan(startup)이 돌지 않은 경우: 'NoneType' 에러 대신 원인을 알려 준다.
+        raise RuntimeError("봇 API 세션이 초기화되지 않았습니다. (앱 startup 미실행)")
+
+    url = _BOT_API_BASE_URL.update_query(m=user_text)
+
+    async with SESSION.get(url) as resp:
+        # status가 4xx/5xx여도 "원문"이 중요하면 body 그대로 가져온다.
+        # resp.text()의 charset 판별/디코딩을 건너뛰려고 바이트로 읽는다.
+        raw_body = await resp.read()
+
+        # 그래도 status 정보를 시스템이 알 수 있게 하고 싶으면, 여기서 에러로 보내지 말고 raw_body에 맡긴다.
+        # 단, 네가 원하면 status>=400일 때 type:error로 별도 처리도 가능.
+
+        return raw_body
+
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.get(BOT_API_URL, params=params) as resp:
-            # status가 4xx/5xx여도 "원문"이 중요하면 text 그대로 가져온다.
-            raw_text = await resp.text()
+def _error_frame(prefix: bytes, e: Exception) -> bytes:
+    # 예외 메시지만 직렬화해서 미리 만든 에러 프레임 앞부분 뒤에 붙인다. (앞뒤 따옴표 제거)
+    return prefix + _dumps(str(e))[1:-1] + _ERR_SUFFIX
 
-            # 그래도 status 정보를 시스템이 알 수 있게 하고 싶으면, 여기서 에러로 보내지 말고 raw_text에 맡긴다.
-            # 단, 네가 원하면 status>=400일 때 type:error로 별도 처리도 가능.
 
-            return raw_text
+def _message_frame(raw_body: bytes) -> bytes:
+    # {"type":"message","role":"assistant","message": <원문 문자열>} 을
+    # dict를 만들지 않고 미리 직렬화한 앞/뒤 조각으로 감싸서 만든다.
+    return (
+        _MESSAGE_PREFIX
+        + _dumps(raw_body.decode("utf-8", errors="replace"))
+        + _MESSAGE_SUFFIX
+    )
+
+
+# 전송 중 연결이 닫혔을 때 나는 예외들. (uvicorn은 닫힌 뒤 send하면 RuntimeError를 낸다)
+_DISCONNECT_ERRORS = (ConnectionClosed, WebSocketDisconnect, RuntimeError)
+
+
+async def _drain(websocket: WebSocket, out_q: "asyncio.Queue[bytes]"):
+    # 연결당 하나의 writer가 큐에 쌓인 프레임을 순서대로 보낸다.
+    while True:
+        frame = await out_q.get()
+        try:
+            await websocket.send_bytes(frame)
+            out_q.task_done()
+        except _DISCONNECT_ERRORS:
+            # 클라이언트가 먼저 닫은 경우(탭 닫기 등)는 정상 종료로 본다.
+            logger.debug("websocket 연결이 닫혀 전송을 멈춥니다.")
+            raise
+        except Exception:
+            logger.exception("websocket 전송 실패")
+            raise
+
+
+async def _enqueue(
+    out_q: "asyncio.Queue[bytes]", writer: "asyncio.Task[None]", frame: bytes
+):
+    # writer가 이미 죽었으면 아무도 보내지 않을 프레임을 쌓지 말고 그 에러를 올린다.
+    if writer.done():
+        writer.result()
+    if not out_q.full():
+        out_q.put_nowait(frame)
+        return
+
+    # 큐가 가득 찬 동안 writer가 죽으면 put이 영원히 막히므로 writer도 같이 기다린다.
+    put = asyncio.create_task(out_q.put(frame))
+    try:
+        await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        put.cancel()
+    if writer.done():
+        writer.result()
+
+
+async def _flush(
+    out_q: "asyncio.Queue[bytes]", writer: "asyncio.Task[None]", frame: bytes
+):
+    # 마지막 프레임을 큐 뒤에 붙이고, writer가 앞의 프레임까지 모두 보낼 때까지 기다린다.
+    await _enqueue(out_q, writer, frame)
+    join = asyncio.create_task(out_q.join())
+    try:
+        # writer가 죽으면 join은 끝나지 않으므로 writer도 같이 기다린다.
+        await asyncio.wait({join, writer}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        join.cancel()
 
 
 async def ws_chatbot(websocket: WebSocket):
     await websocket.accept()
 
-    # ✅ 최초 접속 인사 (사람이 읽는 텍스트만)
-    await websocket.send_text(
-        json.dumps(
-            {
-                "type": "greeting",
-                "role": "assistant",
-                "message": (
-                    "안녕하세요 😊\n"
-                    "신한투자증권 프로봇입니다.\n\n"
-                    "클라우드, 개발, 기술 관련 질문이 있다면\n"
-                    "편하게 물어보세요!"
-                ),
-            },
-            ensure_ascii=False,
-        )
-    )
+    # 큐 크기를 제한해 느린 클라이언트는 메모리를 늘리는 대신 수신 루프를 멈추게 한다.
+    out_q: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=_OUT_QUEUE_SIZE)
+    writer = asyncio.create_task(_drain(websocket, out_q))
 
     try:
+        # ✅ 최초 접속 인사 (사람이 읽는 텍스트만)
+        await _enqueue(out_q, writer, _GREETING_BYTES)
+
         while True:
             raw = await websocket.receive_text()
+            # 파싱 전에 바이트 크기로 자른다. (uvicorn --ws-max-size는 이보다 큰 프레임만 끊는다)
+            if _too_long(raw):
+                await _enqueue(out_q, writer, _TOO_LONG_ERR_BYTES)
+                continue
 
-            try:
-                payload = json.loads(raw)
-            except Exception:
+            # JSON 객체는 항상 "{"로 시작하므로, 평문은 예외 없이 바로 처리한다.
+            if raw.lstrip()[:1] == "{":
+                try:
+                    payload = orjson.loads(raw)
+                except orjson.JSONDecodeError:
+                    payload = {"message": raw}
+            else:
                 payload = {"message": raw}
 
             user_text = _extract_user_message(payload)
             if not user_text:
-                await websocket.send_text(
-                    json.dumps(
-                        {
-                            "type": "error",
-                            "role": "system",
-                            "message": "빈 메시지는 처리할 수 없습니다.",
-                        },
-                        ensure_ascii=False,
-                    )
-                )
+                await _enqueue(out_q, writer, _EMPTY_ERR_BYTES)
                 continue
 
-            # typing
-            await websocket.send_text(
-                json.dumps(
-                    {
-                        "type": "typing",
-                        "role": "system",
-                        "message": f"{BOT_NAME}이(가) 입력 중입니다…",
-                    },
-                    ensure_ascii=False,
-                )
-            )
-
+            # typing: 봇 응답이 _TYPING_DELAY 안에 오면 생략해 프레임 하나만 보낸다.
+            # 봇 호출은 이미 태스크로 진행 중이고 typing 전송은 writer가 맡으므로 서로 겹쳐서 진행된다.
+            bot_task = asyncio.create_task(call_bot_api_raw(user_text))
             try:
-                bot_raw = await call_bot_api_raw(user_text)
-            except Exception as e:
-                await websocket.send_text(
-                    json.dumps(
-                        {
-                            "type": "error",
-                            "role": "system",
-                            "message": f"봇 호출 실패: {str(e)}",
-                        },
-                        ensure_ascii=False,
-                    )
-                )
-                continue
+                done, _ = await asyncio.wait({bot_task}, timeout=_TYPING_DELAY)
+                if not done:
+                    try:
+                        # typing은 생략해도 되는 프레임이라 큐가 가득 차 있으면 기다리지 않고 버린다.
+                        out_q.put_nowait(_TYPING_BYTES)
+                    except asyncio.QueueFull:
+                        pass
+
+                try:
+                    bot_raw = await bot_task
+                except Exception as e:
+                    await _enqueue(out_q, writer, _error_frame(_BOT_ERR_PREFIX, e))
+                    continue
+            finally:
+                # asyncio.wait는 취소를 bot_task로 넘기지 않으므로, 핸들러가 취소되면 직접 멈춘다.
+                if not bot_task.done():
+                    bot_task.cancel()
 
             # ✅ 여기서 파싱/가공 없이 그대로 전달
-            await websocket.send_text(
-                json.dumps(
-                    {
-                        "type": "message",
-                        "role": "assistant",
-                        "message": bot_raw,
-                    },
-                    ensure_ascii=False,
-                )
-            )
+            await _enqueue(out_q, writer, _message_frame(bot_raw))
 
     except WebSocketDisconnect:
         return
     except Exception as e:
+        if writer.done():
+            # 전송이 이미 실패했거나 닫힌 연결이라 에러 프레임도 보낼 수 없다.
+            return
+        # 이미 큐에 쌓인 프레임(직전 봇 응답 등)을 먼저 보낸 뒤 에러 프레임을 보낸다.
         try:
-            await websocket.send_text(
-                json.dumps(
-                    {
-                        "type": "error",
-                        "role": "system",
-                        "message": f"서버 오류: {str(e)}",
-                    },
-                    ensure_ascii=False,
-                )
+            await asyncio.wait_for(
+                _flush(out_q, writer, _error_frame(_SERVER_ERR_PREFIX, e)),
+                timeout=_FLUSH_TIMEOUT,
             )
         except Exception:
             pass
+    finally:
+        writer.cancel()
+        await asyncio.wait({writer})
+        if not writer.cancelled():
+            # 전송 실패는 _drain에서 이미 처리(로깅)했으므로 결과만 회수한다.
+            writer.exception()
+
+
+async def _startup():
+    global SESSION
+    SESSION = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=45),
+        connector=aiohttp.TCPConnector(
+            # 총 연결 수 제한은 풀고 봇 API 호스트 기준으로만 제한한다.
+            limit=0,
+            limit_per_host=200,
+            use_dns_cache=True,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            # API Gateway는 IPv4로 붙으므로 AAAA 조회/happy-eyeballs를 건너뛴다.
+            family=socket.AF_INET,
+        ),
+    )
+
+
+async def _shutdown():
+    if SESSION is not None:
+        await SESSION.close()
 
 
 routes = [
@@ -181,4 +342,9 @@ routes = [
     WebSocketRoute("/ws", ws_chatbot),
 ]
 
-app = Starlette(routes=routes, middleware=middleware)
+app = Starlette(
+    routes=routes,
+    middleware=middleware,
+    on_startup=[_startup],
+    on_shutdown=[_shutdown],
+)